@@ -2,9 +2,12 @@ import os
 import json
 import math
 import collections
+import concurrent.futures
 
 import bisect
 import copy
+import operator
+import functools
 import itertools
 
 import torch
@@ -12,6 +15,8 @@ import torch.utils.data
 import torch.nn.functional as F
 import torchvision
 
+import pix3d
+
 def create_aspect_ratio_groups(aspect_ratios, k=0):
     bins = (2 ** torch.linspace(-1, 1, 2 * k + 1)).tolist() if k > 0 else [1.0]
     bins = sorted(copy.deepcopy(bins))
@@ -24,28 +29,50 @@ def create_aspect_ratio_groups(aspect_ratios, k=0):
     return groups
     
 
+@functools.lru_cache()
+def thread_pool(pid, max_workers):
+    # keyed by pid: threads do not survive fork, so every data loader worker creates its own pool on first use
+    # JPEG / PNG decoding releases the GIL, so views of one example are decoded in parallel
+    return concurrent.futures.ThreadPoolExecutor(max_workers = max_workers)
+
+@functools.lru_cache()
+def load_object_rotation_quat(object_rotation_quat_path, categories):
+    # parsed once for all RenderedViews of a run, shared memory so that data loader workers map the same pages
+    object_rotation_quat = torch.tensor(list(map(json.load(open(object_rotation_quat_path)).get, categories[1:])), dtype = torch.float32)
+    return torch.cat([torch.zeros_like(object_rotation_quat[:1]), object_rotation_quat]).share_memory_()
+
+@functools.lru_cache()
+def list_files(root):
+    # walked once per root for all RenderedViews of a run instead of a stat per view per example, paths are normalized on both sides
+    return frozenset(os.path.normpath(os.path.join(dirpath, file_name)) for dirpath, dirnames, file_names in os.walk(root) for file_name in file_names)
+
 class RenderedViews(torchvision.datasets.VisionDataset):
-    def __init__(self, root, object_rotation_quat_path, dataset, transforms = None, ext = '.jpg', read_image = True, read_mask = True):
+    def __init__(self, root, object_rotation_quat_path, dataset, transforms = None, ext = '.jpg', read_image = True, read_mask = True, encoded_views = False, num_threads = 8):
         super().__init__(root = root, transforms = transforms)
+        self.num_threads = num_threads
+        self.existing_paths = list_files(root)
+        self.encoded_views = encoded_views
         self.dataset = dataset
         self.ext = ext
         self.read_image = read_image
         self.read_mask = read_mask
-        self.object_rotation_quat = torch.tensor(list(map(json.load(open(object_rotation_quat_path)).get, dataset.categories[1:])), dtype = torch.float32)
-        self.object_rotation_quat = torch.cat([torch.zeros_like(self.object_rotation_quat[:1]), self.object_rotation_quat])
+        self.object_rotation_quat = load_object_rotation_quat(object_rotation_quat_path, tuple(dataset.categories))
 
     def __getitem__(self, idx):
         images, targets = self.dataset.__getitem__(idx[0], read_image = self.read_image, read_mask = self.read_mask) 
         view_dir = os.path.join(self.root, targets['shape_path'])
 
-        or_jpg = lambda path, ext = '.png': torchvision.io.read_image(path if os.path.exists(path) else path.replace(ext, '.jpg'))
+        read_view = lambda path: pix3d.read_encoded(path, torchvision.io.ImageReadMode.GRAY) if self.encoded_views else pix3d.load_image(path, torchvision.io.ImageReadMode.GRAY)
+        or_jpg = lambda path, ext = '.png': read_view(path if os.path.normpath(path) in self.existing_paths else path.replace(ext, '.jpg'))
         no_img = lambda idx: [k for k in idx if k > 0]
         # TODO: rerender to eliminate fixup
         fixup = lambda path: path #if os.path.exists(path) else os.path.join(os.path.dirname(os.path.dirname(path)), 'model.obj', os.path.basename(path))
         
-        views = torch.stack([or_jpg(os.path.join(self.root, targets['image_id']) if k == 0 else fixup(os.path.join(view_dir, f'{k:04}' + self.ext))) for k in no_img(idx[1:])])
+        view_paths = [os.path.join(self.root, targets['image_id']) if k == 0 else fixup(os.path.join(view_dir, f'{k:04}' + self.ext)) for k in no_img(idx[1:])]
+        views = list(thread_pool(os.getpid(), self.num_threads).map(or_jpg, view_paths)) if self.num_threads > 1 and len(view_paths) > 1 else list(map(or_jpg, view_paths))
 
-        targets['shape_views'] = views.expand(-1, 3, -1, -1) / 255.0
+        # uint8 single channel, normalized and broadcast to RGB after the transfer by models.normalize_views
+        targets['shape_views'] = views if self.encoded_views else torch.stack(views)
 
         return images, targets
 
@@ -70,7 +97,8 @@ class RenderedViewsRandomSampler(torch.utils.data.Sampler):
         self.num_rendered_views = num_rendered_views
         self.num_sampled_views = num_sampled_views
         self.num_sampled_boxes = num_sampled_boxes
-        self.idx = None
+        # idx is drawn up front so that len() is valid before the first set_epoch, e.g. for the per-iteration LR schedule in train.py
+        self.set_epoch(0)
 
     def set_epoch(self, epoch):
         rng = torch.Generator()
@@ -78,7 +106,12 @@ class RenderedViewsRandomSampler(torch.utils.data.Sampler):
 
         example_idx   = torch.arange(self.num_examples, dtype = torch.int64)[:, None]
         main_view_idx = torch. zeros(self.num_examples, dtype = torch.int64)[:, None]
-        novel_view_idx = 1 + torch.rand(self.num_examples * self.num_sampled_boxes, self.num_rendered_views, generator = rng).argsort(-1)[..., :self.num_sampled_views].reshape(self.num_examples, -1)
+        # K views without replacement out of V: topk of uniform noise instead of a full argsort, a single draw needs no noise matrix at all
+        num_sampled_views = min(self.num_sampled_views, self.num_rendered_views)
+        if num_sampled_views == 1:
+            novel_view_idx = 1 + torch.randint(self.num_rendered_views, (self.num_examples * self.num_sampled_boxes, 1), generator = rng).reshape(self.num_examples, -1)
+        else:
+            novel_view_idx = 1 + torch.rand(self.num_examples * self.num_sampled_boxes, self.num_rendered_views, generator = rng).topk(num_sampled_views, dim = -1, largest = False).indices.reshape(self.num_examples, -1)
 
         #self.idx = torch.cat([example_idx, main_view_idx, novel_view_idx], dim = -1)
         self.idx = torch.cat([example_idx, novel_view_idx], dim = -1)
@@ -104,34 +137,87 @@ class UniqueShapeRenderedViewsSequentialSampler(torch.utils.data.Sampler):
         return len(self.dataset)
     
 def stack_jagged(tensors, fill_value = 0):
+    # per-sample boxes / labels / poses and same-sized images need no padding: one allocation instead of full + copy per sample
+    if all(t.shape == tensors[0].shape for t in tensors):
+        return torch.stack(tensors)
     shape = [len(tensors)] + [max(t.shape[dim] for t in tensors) for dim in range(len(tensors[0].shape))]
     res = torch.full(shape, fill_value, dtype = tensors[0].dtype, device = tensors[0].device)
     for u, t in zip(res, tensors):
         u[tuple(map(slice, t.shape))] = t
     return res
 
+def decode_images(images, device, mode = torchvision.io.ImageReadMode.RGB, image_height_width = None):
+    # JPEG bytes (uint8 1-D) are decoded by a single batched nvjpeg call, other images arrive decoded as uint8 from the CPU
+    encoded = [i for i, img in enumerate(images) if img.ndim == 1]
+    decoded = dict(zip(encoded, torchvision.io.decode_jpeg([images[i] for i in encoded], mode = mode, device = device))) if encoded else {}
+    images = [decoded.get(i, img).to(device, non_blocking = True) / 255.0 for i, img in enumerate(images)]
+    # bilinear resize to the size recorded by the dataset (e.g. Pix3d target_image_size), on device after decoding
+    resize = lambda img, hw: F.interpolate(img.unsqueeze(0), hw, mode = 'bilinear', align_corners = False).squeeze(0) if tuple(img.shape[-2:]) != tuple(hw) else img
+    return [resize(img, hw) for img, hw in zip(images, image_height_width)] if image_height_width is not None else images
+
 def collate_fn(batch):
     assert batch
-    images = stack_jagged([b[0] for b in batch])
+    # one C-level transpose of samples into per-key columns instead of a Python pass over the batch per key
+    images, targets = zip(*batch)
+    keys = list(targets[0])
+    t = dict(zip(keys, zip(*map(operator.itemgetter(*keys), targets))))
+    
+    # encoded images and views (see pix3d.read_encoded) are kept as lists and decoded after transfer by decode_images
+    images = list(images) if any(img.ndim == 1 for img in images) else stack_jagged(images)
     targets = dict(
-        image_id        = [b[1]['image_id']                     for b in batch], 
-        shape_path      = [b[1]['shape_path']                   for b in batch], 
-        mask_path       = [b[1]['mask_path']                    for b in batch], 
-        category        = [b[1]['category']                     for b in batch],
-        image_height_width = torch.tensor([b[1]['image_height_width']   for b in batch], dtype = torch.int16),
-        image_height_width_resized = torch.tensor([b[1].get('image_height_width_resized', b[1]['image_height_width']) for b in batch], dtype = torch.int16),
-
-        num_boxes       = torch.tensor([len(b[1]['boxes'])      for b in batch]),
-        boxes           = stack_jagged([b[1]['boxes']           for b in batch]),
-        masks           = stack_jagged([b[1]['masks']           for b in batch]), 
-        shape_idx       = stack_jagged([b[1]['shape_idx']       for b in batch]), 
-        labels          = stack_jagged([b[1]['labels']          for b in batch]), 
-        object_location = stack_jagged([b[1]['object_location'] for b in batch]),
-        object_rotation = stack_jagged([b[1]['object_rotation'] for b in batch]),
-        shape_views     = stack_jagged([b[1]['shape_views']     for b in batch]) if 'shape_views' in batch[0][1] else None
+        image_id        = list(t['image_id']), 
+        shape_path      = list(t['shape_path']), 
+        mask_path       = list(t['mask_path']), 
+        category        = list(t['category']),
+        image_height_width = torch.tensor(t['image_height_width'], dtype = torch.int16),
+        image_height_width_resized = torch.tensor(t.get('image_height_width_resized', t['image_height_width']), dtype = torch.int16),
+
+        num_boxes       = torch.tensor(list(map(len, t['boxes']))),
+        boxes           = stack_jagged(t['boxes']),
+        masks           = stack_jagged(t['masks']), 
+        shape_idx       = stack_jagged(t['shape_idx']), 
+        labels          = stack_jagged(t['labels']), 
+        object_location = stack_jagged(t['object_location']),
+        object_rotation = stack_jagged(t['object_rotation']),
+        shape_views     = (stack_jagged(t['shape_views']) if torch.is_tensor(t['shape_views'][0]) else [v for views in t['shape_views'] for v in views]) if 'shape_views' in t else None
     )
     return images, targets
 
+class CUDAPrefetcher:
+    # https://github.com/NVIDIA/apex/blob/master/examples/imagenet/main_amp.py
+    # to_device of the next batch runs on a side stream while the current batch is consumed
+    def __init__(self, data_loader, device, to_device):
+        self.data_loader = data_loader
+        self.device = device
+        self.to_device = to_device
+        self.stream = torch.cuda.Stream(device = device) if torch.device(device).type == 'cuda' else None
+
+    def preload(self, it):
+        batch = next(it, None)
+        if batch is not None and self.stream is not None:
+            with torch.cuda.stream(self.stream):
+                batch = self.to_device(*batch, self.device)
+        return batch
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from (self.to_device(*batch, self.device) for batch in self.data_loader)
+            return
+        
+        it = iter(self.data_loader)
+        batch = self.preload(it)
+        while batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            images, targets = batch
+            for t in [images] + [v for v in targets.values() if torch.is_tensor(v)]:
+                t.record_stream(torch.cuda.current_stream())
+            next_batch = self.preload(it)
+            yield batch
+            batch = next_batch
+
+    def __len__(self):
+        return len(self.data_loader)
+
 # https://github.com/pytorch/pytorch/issues/23430
 # https://discuss.pytorch.org/t/how-to-use-my-own-sampler-when-i-already-use-distributedsampler/62143/22
 # https://github.com/catalyst-team/catalyst/blob/master/catalyst/data/sampler.py
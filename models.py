@@ -1,4 +1,5 @@
 import math
+import functools
 
 import torch
 import torch.nn as nn
@@ -7,24 +8,68 @@ import torchvision
 
 import quat
 import utils
+import datasets
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+def normalize_views(shape_views, device = None):
+    # rendered views arrive as single channel uint8, conversion to float and broadcast to RGB happen after the transfer
+    shape_views = shape_views.to(device, non_blocking = True) if device is not None else shape_views
+    shape_views = shape_views if shape_views.is_floating_point() else shape_views.float().div_(255.0)
+    return shape_views.expand(shape_views.shape[:-3] + (3,) + shape_views.shape[-2:])
+
+def to_memory_format(memory_format, module, args):
+    # forward pre-hook, module-level and bound with functools.partial so that the hooked module stays pickle-able
+    return tuple(arg.contiguous(memory_format = memory_format) if torch.is_tensor(arg) and arg.ndim == 4 else arg for arg in args)
 
 class ShapeRetrieval(nn.Module):
-    def __init__(self, shape_data_loader, rendered_view_encoder):
+    def __init__(self, shape_data_loader, rendered_view_encoder, ivf_min_size = 100_000, ivf_nprobe = 8, dtype = torch.float32):
         super().__init__()
+        self.ivf_min_size = ivf_min_size
+        self.ivf_nprobe = ivf_nprobe
+        self.index = None
+        device = next(rendered_view_encoder.parameters()).device
+        # encoded views (see --decode-on-device) are decoded in batch on device, same as train.to_device
+        decoded = lambda targets: dict(targets, shape_views = torch.stack(datasets.decode_images(targets['shape_views'], device, mode = torchvision.io.ImageReadMode.GRAY)).unflatten(0, (len(targets['shape_idx']), -1))) if isinstance(targets['shape_views'], list) else targets
 
-        self.shape_embedding, self.shape_idx, self.shape_path = zip(*[(rendered_view_encoder(targets['shape_views'].flatten(end_dim = -4)), targets['shape_idx'].repeat(1, targets['shape_views'].shape[-4]).flatten(), [pp for p in targets['shape_path'] for pp in [p] * targets['shape_views'].shape[-4] ]  ) for img, targets in shape_data_loader])
-        self.shape_embedding, self.shape_idx, self.shape_path = F.normalize(torch.cat(self.shape_embedding), dim = -1), torch.cat(self.shape_idx), [s for b in self.shape_path for s in b]
+        self.shape_embedding, self.shape_idx, self.shape_path = zip(*[(rendered_view_encoder(normalize_views(targets['shape_views'], device).flatten(end_dim = -4)), targets['shape_idx'].repeat(1, targets['shape_views'].shape[-4]).flatten(), [pp for p in targets['shape_path'] for pp in [p] * targets['shape_views'].shape[-4] ]  ) for img, targets in map(lambda batch: (batch[0], decoded(batch[1])), shape_data_loader)])
+        # a lower dtype halves the memory traffic of exact search, but neighbouring cosine scores may tie or swap, so it is opt-in
+        self.shape_embedding, self.shape_idx, self.shape_path = F.normalize(torch.cat(self.shape_embedding), dim = -1).to(dtype), torch.cat(self.shape_idx), [s for b in self.shape_path for s in b]
+
+    def build_index(self):
+        # inner product of normalized embeddings is cosine similarity, IVF with sqrt(R) lists only scans ivf_nprobe lists per query
+        shape_embedding = self.shape_embedding.detach().cpu().float().numpy()
+        index = faiss.index_factory(shape_embedding.shape[-1], 'IVF{},Flat'.format(int(math.sqrt(len(shape_embedding)))), faiss.METRIC_INNER_PRODUCT)
+        index.train(shape_embedding)
+        index.add(shape_embedding)
+        index.nprobe = self.ivf_nprobe
+        return index
 
     def forward(self, shape_embedding, topk = 10):
-        idx = F.normalize(shape_embedding, dim = -1).matmul(self.shape_embedding.t()).topk(topk, dim = -1, largest = True).indices.cpu()
+        shape_embedding = F.normalize(shape_embedding, dim = -1)
+        exact_search = lambda shape_embedding: shape_embedding.to(self.shape_embedding.dtype).matmul(self.shape_embedding.t()).topk(topk, dim = -1, largest = True).indices.cpu()
+        if faiss is not None and len(self.shape_embedding) >= self.ivf_min_size:
+            self.index = self.index if self.index is not None else self.build_index()
+            idx = torch.as_tensor(self.index.search(shape_embedding.detach().cpu().float().numpy(), topk)[1])
+            # FAISS pads with -1 ids when the probed lists hold fewer than topk entries, such queries are answered by exact search
+            missing = (idx < 0).any(dim = -1)
+            if missing.any():
+                idx[missing] = exact_search(shape_embedding[missing.to(shape_embedding.device)])
+        else:
+            idx = exact_search(shape_embedding)
         return self.shape_idx[idx], [self.shape_path[i[0]] for i in idx.tolist()]
 
     def synchronize_between_processes(self):
         self.shape_embedding, self.shape_idx, self.shape_path = torch.cat(utils.all_gather(self.shape_embedding)), torch.cat(utils.all_gather(self.shape_idx)), [s for ls in utils.all_gather(self.shape_path) for s in ls] 
+        self.index = None
 
 class Mask2CAD(nn.Module):
-    def __init__(self, *, num_categories = 10, embedding_dim = 256, num_rotation_clusters = 16, shape_embedding_dim = 128, num_detections_per_image = 8, object_rotation_quat = None, **kwargs_backbone):
+    def __init__(self, *, num_categories = 10, embedding_dim = 256, num_rotation_clusters = 16, shape_embedding_dim = 128, num_detections_per_image = 8, object_rotation_quat = None, channels_last = False, compile_branches = False, **kwargs_backbone):
         super().__init__()
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
         self.register_buffer('object_rotation_quat', object_rotation_quat)
         self.num_rotation_clusters = num_rotation_clusters
         self.num_categories = len(object_rotation_quat)
@@ -40,6 +85,13 @@ class Mask2CAD(nn.Module):
         self.object_detector.roi_heads.mask_roi_pool = CacheInputOutput(self.object_detector.roi_heads.mask_roi_pool)
         self.object_detector.roi_heads.detections_per_img = num_detections_per_image
         
+        # NHWC lets cuDNN pick tensor core convolution kernels
+        # GeneralizedRCNNTransform pads images into a fresh NCHW batch, so the detector input is converted right before the backbone
+        # rendered views are converted in forward
+        self.rendered_view_encoder = self.rendered_view_encoder.to(memory_format = self.memory_format)
+        self.object_detector = self.object_detector.to(memory_format = self.memory_format)
+        self.object_detector.backbone.register_forward_pre_hook(functools.partial(to_memory_format, self.memory_format))
+        
         conv_bn_relu = lambda in_channels = embedding_dim, out_channels = embedding_dim, kernel_size = 3: nn.Sequential(nn.Conv2d(in_channels, out_channels, kernel_size = kernel_size, padding = kernel_size // 2), nn.BatchNorm2d(out_channels), nn.ReLU(True))
         
         self.shape_embedding_branch = nn.Sequential(*([conv_bn_relu() for k in range(3)] + [conv_bn_relu(embedding_dim, shape_embedding_dim), nn.AdaptiveAvgPool2d(1), nn.Flatten(start_dim = -3)]))
@@ -47,6 +99,10 @@ class Mask2CAD(nn.Module):
         self.pose_refinement_branch = nn.Sequential(*([conv_bn_relu() for k in range(4)] + [nn.AdaptiveAvgPool2d(1), nn.Flatten(start_dim = -3), nn.Linear(embedding_dim, self.num_categories * self.num_rotation_clusters * 4)]))
         self.center_regression_branch = nn.Sequential(*([conv_bn_relu() for k in range(4)] + [nn.AdaptiveAvgPool2d(1), nn.Flatten(start_dim = -3), nn.Linear(embedding_dim, self.num_categories * self.num_rotation_clusters * 2)]))
 
+        # compiled in place per branch, the module stays deepcopy- / pickle-able, the number of boxes (fixed in training, varying in evaluation) is left to automatic dynamic shapes
+        for branch in ([self.shape_embedding_branch, self.pose_classification_branch, self.pose_refinement_branch, self.center_regression_branch] if compile_branches else []):
+            branch.compile(dynamic = None)
+
         self.reset_parameters()
 
     @torch.no_grad()
@@ -56,7 +112,7 @@ class Mask2CAD(nn.Module):
 
     def forward(self, images, targets, mode = None, Pfactor = 4, Nfactor = 8): # 4, 16
         bbox, category_idx, masks, shape_idx, object_location, object_rotation_quat = map(targets.get, ['boxes', 'labels', 'masks', 'shape_idx', 'object_location', 'object_rotation_quat'])
-        
+
         if mode == 'MaskRCNN':
             detections = [dict(labels = l, boxes = b, masks = m) for l, b, m in zip(category_idx, bbox, masks)]
             self.object_detector.eval()
@@ -91,24 +147,24 @@ class Mask2CAD(nn.Module):
             bbox = torch.cat([d['boxes'] for d in detections])
         
         box_features          = F.interpolate(box_features, mask_probs.shape[-2:]) * mask_probs.unsqueeze(-3)
-        shape_embedding       = self.shape_embedding_branch(box_features)
-        object_rotation_bins  = self.pose_classification_branch(box_features).unflatten(-1, (self.num_categories, self.num_rotation_clusters))
-        object_rotation_delta =     self.pose_refinement_branch(box_features).unflatten(-1, (self.num_categories, self.num_rotation_clusters, 4))
-        center_delta          =   self.center_regression_branch(box_features).unflatten(-1, (self.num_categories, self.num_rotation_clusters, 2))
+        shape_embedding, object_rotation_bins, object_rotation_delta, center_delta = self.predict_branches(box_features)
         #object_rotation_bins, object_rotation_delta, center_delta = [self.index_select_batched(t, category_idx) for t in [object_rotation_bins, object_rotation_delta, center_delta]]
 
         if self.training:
             B, Q, V = images.shape[0], category_idx.shape[-1], targets['shape_views'].shape[-4] // category_idx.shape[-1]
-            rendered_view_features = self.rendered_view_encoder(targets['shape_views'].flatten(end_dim = -4)).unflatten(0, (B, Q, V))
+            rendered_view_features = self.rendered_view_encoder(normalize_views(targets['shape_views']).flatten(end_dim = -4).contiguous(memory_format = self.memory_format)).unflatten(0, (B, Q, V))
        
             target_object_rotation_bins, target_object_rotation_mask, target_object_rotation_delta, target_center_delta = self.compute_rotation_location_targets(category_idx, bbox.unflatten(0, (B, Q)), object_location, object_rotation_quat = quat.from_matrix(targets['object_rotation']))
             
             shape_embedding_loss = self.shape_embedding_loss(shape_embedding.unflatten(0, (B, Q)), rendered_view_features, category_idx = category_idx, shape_idx = shape_idx, P = Pfactor * Q, N = Nfactor * Q)
 
+            # one gather by category for the three pose heads
+            pred_object_rotation_bins, pred_object_rotation_delta, pred_center_delta = self.index_select_batched(torch.cat([object_rotation_bins.unsqueeze(-1), object_rotation_delta, center_delta], dim = -1).unflatten(0, (B, Q)), category_idx).split([1, 4, 2], dim = -1)
+
             pose_classification_loss, pose_regression_loss, center_regression_loss = self.pose_estimation_loss(
-                pred_object_rotation_bins  = self.index_select_batched(object_rotation_bins .unflatten(0, (B, Q)), category_idx), 
-                pred_object_rotation_delta = self.index_select_batched(object_rotation_delta.unflatten(0, (B, Q)), category_idx), 
-                pred_center_delta          = self.index_select_batched(center_delta         .unflatten(0, (B, Q)), category_idx), 
+                pred_object_rotation_bins  = pred_object_rotation_bins.squeeze(-1), 
+                pred_object_rotation_delta = pred_object_rotation_delta, 
+                pred_center_delta          = pred_center_delta, 
                 true_object_rotation_bins  = target_object_rotation_bins, 
                 true_object_rotation_mask  = target_object_rotation_mask, 
                 true_object_rotation_delta = target_object_rotation_delta, 
@@ -121,7 +177,7 @@ class Mask2CAD(nn.Module):
             I = self.index_select_batched(object_rotation_bins.argmax(dim = -1), category_idx)
             anchor_quat = self.index_select_batched(self.object_rotation_quat[category_idx], I)
             object_rotation = quat.quatprod(anchor_quat, self.index_select_batched(object_rotation_delta, category_idx, I))
-            center_xy, height_width = self.xyxy_to_cxcywh(bbox).split(2, dim = -1)
+            center_xy, width_height = self.xyxy_to_cxcywh(bbox).split(2, dim = -1)
             object_location = center_xy + self.index_select_batched(center_delta, category_idx, I) * width_height
             num_boxes = [len(d['boxes']) for d in detections]
             image_id = targets['image_id'] if targets else [None] * len(images)
@@ -134,6 +190,13 @@ class Mask2CAD(nn.Module):
 
             return detections
     
+    def predict_branches(self, box_features):
+        shape_embedding       = self.shape_embedding_branch(box_features)
+        object_rotation_bins  = self.pose_classification_branch(box_features).unflatten(-1, (self.num_categories, self.num_rotation_clusters))
+        object_rotation_delta =     self.pose_refinement_branch(box_features).unflatten(-1, (self.num_categories, self.num_rotation_clusters, 4))
+        center_delta          =   self.center_regression_branch(box_features).unflatten(-1, (self.num_categories, self.num_rotation_clusters, 2))
+        return shape_embedding, object_rotation_bins, object_rotation_delta, center_delta
+    
     def compute_rotation_location_targets(self, category_idx : 'BQ', bbox : 'BQ4', object_location : 'BQ3', object_rotation_quat : 'BQ4', theta = math.pi / 6):
         anchor_quat = self.object_rotation_quat[category_idx]
         object_rotation_angle = quat.quatcdist(object_rotation_quat.unsqueeze(-2), anchor_quat).squeeze(-2)
@@ -168,8 +231,8 @@ class Mask2CAD(nn.Module):
         same_shape = shape_idx.reshape(-1, 1) == shape_idx.unsqueeze(-1).expand(-1, -1, rendered_view_features.shape[-2]).reshape(1, -1)
         same_category = category_idx.reshape(-1, 1) == category_idx.unsqueeze(-1).expand(-1, -1, rendered_view_features.shape[-2]).reshape(1, -1)
 
-        Dpos = torch.where(same_shape, D, torch.full_like(D, float('inf'))).topk(min(P, D.shape[-1]), dim = -1, largest = False).values
-        Dneg = torch.where(same_category, D, torch.full_like(D, float('-inf'))).topk(min(N, D.shape[-1]), dim = -1, largest = True).values
+        Dpos = D.masked_fill(~same_shape, float('inf')).topk(min(P, D.shape[-1]), dim = -1, largest = False).values
+        Dneg = D.masked_fill(~same_category, float('-inf')).topk(min(N, D.shape[-1]), dim = -1, largest = True).values
 
         loss = -(Dpos / (Dpos + C * Dneg.sum(dim = -1, keepdim = True))).log().sum(dim = -1)
 
@@ -177,14 +240,12 @@ class Mask2CAD(nn.Module):
 
     @staticmethod
     def xyxy_to_cxcywh(bbox):
-        width, height = (bbox[..., 2] - bbox[..., 0]), (bbox[..., 3] - bbox[..., 1])
-        center_x, center_y = (bbox[..., 0] + width / 2), (bbox[..., 1] + height / 2)
-        return torch.stack([center_x, center_y, width, height], dim = -1)
+        return torch.cat([(bbox[..., :2] + bbox[..., 2:]) / 2, bbox[..., 2:] - bbox[..., :2]], dim = -1)
 
     @staticmethod
     def index_select_batched(tensor, *args):
         for I in args:
-            tensor = tensor.gather(I.ndim, I[(...,) + (None,) * (tensor.ndim - I.ndim)].expand((-1,) * (I.ndim + 1) + tensor.shape[I.ndim + 1:])).squeeze(I.ndim)
+            tensor = torch.take_along_dim(tensor, I.view(I.shape + (1,) * (tensor.ndim - I.ndim)), dim = I.ndim).squeeze(I.ndim)
         return tensor
         
 
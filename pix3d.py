@@ -1,28 +1,82 @@
 import os
 import json
+import math
+import ctypes
+import argparse
+import functools
 import collections
+import concurrent.futures
 import itertools
 
+import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision
+import torchvision.transforms.functional as Fv
 
 import pycocotools.coco, pycocotools.mask
 
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
+
+def torchvision_has_libjpeg_turbo():
+    # libjpeg-turbo exports jpeg_skip_scanlines and the reference libjpeg does not, dlsym on image.so also searches its dependencies
+    try:
+        return hasattr(ctypes.CDLL(torchvision.extension._get_extension_path('image')), 'jpeg_skip_scanlines')
+    except (ImportError, OSError):
+        return False
+
+@functools.lru_cache()
+def turbojpeg_decoder():
+    try:
+        return turbojpeg.TurboJPEG() if turbojpeg is not None and not torchvision_has_libjpeg_turbo() else None
+    except RuntimeError:
+        return None
+
+def load_image(path, mode = torchvision.io.ImageReadMode.UNCHANGED):
+    # falls back to PyTurboJPEG for JPEG if torchvision was not built against libjpeg-turbo, PNG always goes through torchvision
+    decoder = turbojpeg_decoder() if path.lower().endswith(('.jpg', '.jpeg')) else None
+    if decoder is None:
+        return torchvision.io.read_image(path, mode)
+    img = decoder.decode(open(path, 'rb').read(), pixel_format = turbojpeg.TJPF_GRAY if mode == torchvision.io.ImageReadMode.GRAY else turbojpeg.TJPF_RGB)
+    return torch.from_numpy(img).view(img.shape[0], img.shape[1], -1).permute(2, 0, 1)
+
+def read_encoded(path, mode = torchvision.io.ImageReadMode.RGB):
+    # JPEG is returned as raw bytes and decoded later in batch on device by datasets.decode_images, other formats are decoded on CPU
+    return torchvision.io.read_file(path) if path.lower().endswith(('.jpg', '.jpeg')) else load_image(path, mode)
+
 def mask_to_rle(mask):
+    # pycocotools wants Fortran order (H, W[, N]): laid out on the mask's device, then one copy and one encode call for all N masks
     assert mask.ndim == 2 or mask.ndim == 3
-    return pycocotools.mask.encode(mask.to(torch.uint8).t().contiguous().t().numpy()) if mask.ndim == 2 else list(map(mask_to_rle, mask))
+    return pycocotools.mask.encode(mask.to(torch.uint8).transpose(-1, -2).contiguous().cpu().permute(*reversed(range(mask.ndim))).numpy())
 
 class Pix3d(torchvision.datasets.VisionDataset):
     categories           = ['BACKGROUND', 'bed', 'bookcase', 'chair', 'desk', 'misc', 'sofa', 'table', 'tool', 'wardrobe']
     categories_coco_inds = [0,            65   , -1        , 63      , -1   , -1    ,  63   , 67     , -1    ,  -1       ]
 
-    def __init__(self, root, split_path = None, max_image_size = None, drop_images = ('img/table/1749.jpg', 'img/table/0045.png'), transforms = None, **kwargs):
+    def __init__(self, root, split_path = None, max_image_size = None, drop_images = ('img/table/1749.jpg', 'img/table/0045.png'), transforms = None, encoded_images = False, cache_path = None, target_image_size = None, **kwargs):
         super().__init__(root = root, transforms = transforms, **kwargs)
+        assert not (encoded_images and transforms), 'transforms need decoded images'
+        assert not (encoded_images and cache_path), 'cached images are already decoded'
+        self.encoded_images = encoded_images
+        self.cache_path = cache_path
+        self.cache_data = None
+        self.target_image_size = target_image_size
+        self.cache_index = None
+        if cache_path:
+            cache = torch.load(cache_path + '.pt')
+            assert cache['target_image_size'] == (tuple(target_image_size) if target_image_size else None), 'cache was built for image size {}, not {}'.format(cache['target_image_size'], target_image_size)
+            self.cache_index = cache['index']
         metadata_full = json.load(open(os.path.join(root, 'pix3d.json')))
         if split_path:
             split = json.load(open(split_path))
             images = {i['id'] : dict(img = i['file_name'], img_size = [i['width'], i['height']]) for i in split['images']}
-            self.metadata = [dict(bbox = a['bbox'][:2] + [a['bbox'][0] + a['bbox'][2] - 1, a['bbox'][1] + a['bbox'][3] - 1], mask = a['segmentation'], model = a['model'], rot_mat = a['rot_mat'], trans_mat = a['trans_mat'], category = self.categories[a['category_id']], focal_length = a['K'][0] * 32 / images[a['image_id']]['img_size'][0], **images[a['image_id']]) for a in split['annotations']]
+            # xywh -> xyxy for all annotations at once, then plain dict literals per annotation
+            bbox = np.array([a['bbox'] for a in split['annotations']]).reshape(-1, 4)
+            bbox = np.concatenate([bbox[:, :2], bbox[:, :2] + bbox[:, 2:] - 1], axis = -1).tolist()
+            self.metadata = [{'bbox' : b, 'mask' : a['segmentation'], 'model' : a['model'], 'rot_mat' : a['rot_mat'], 'trans_mat' : a['trans_mat'], 'category' : self.categories[a['category_id']], 'focal_length' : a['K'][0] * 32 / img['img_size'][0], **img} for a, b in zip(split['annotations'], bbox) for img in [images[a['image_id']]]]
         else:
             self.metadata = metadata_full
 
@@ -39,23 +93,28 @@ class Pix3d(torchvision.datasets.VisionDataset):
         self.image_idx = {m['img'] : dict(m = m, file_name = m['img'], width = m['img_size'][0], height = m['img_size'][1]) for i, m in enumerate(self.metadata)}
         self.num_by_category = collections.Counter(self.category_idx[m['category']] for m in self.metadata)
         self.aspect_ratios = torch.tensor([width / height for m in self.metadata for width, height in [m['img_size']]], dtype = torch.float32)
+        
+        # per-example targets materialized once as [N, ...] tensors, __getitem__ only slices them
+        boxes = torch.tensor([m['bbox'] for m in self.metadata], dtype = torch.float32).view(-1, 4)
+        self.target_tensors = dict(
+            boxes           = boxes,
+            area            = (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1]),
+            iscrowd         = torch.zeros(len(boxes), dtype = torch.uint8),
+            labels          = torch.tensor([self.category_idx[m['category']] for m in self.metadata], dtype = torch.int64),
+            shape_idx       = torch.tensor([self.shape_idx[m['model']] for m in self.metadata], dtype = torch.int64),
+            object_location = torch.tensor([m['trans_mat'] for m in self.metadata], dtype = torch.float32).view(-1, 3),
+            object_rotation = torch.tensor([m['rot_mat'] for m in self.metadata], dtype = torch.float32).view(-1, 3, 3)
+        )
 
     def __getitem__(self, idx, read_image = True, read_mask = True):
         m = self.metadata[idx]
         width, height = m['img_size']
-        bbox = m['bbox']
         
-        image = (torchvision.io.read_image(os.path.join(self.root, m['img']))[:3]  / 255.0) if read_image else torch.empty((0, height, width), dtype = torch.float32)
-        mask = (torchvision.io.read_image(os.path.join(self.root, m['mask']))     == 255  ) if read_mask  else torch.empty((0, height, width), dtype = torch.bool)
+        image = (read_encoded(os.path.join(self.root, m['img'])) if self.encoded_images else self.load(m['img'])[:3]) if read_image else torch.empty((0, height, width), dtype = torch.float32)
+        mask = (self.load(m['mask'], torchvision.io.ImageReadMode.GRAY) == 255) if read_mask  else torch.empty((0, height, width), dtype = torch.bool)
         
-        bbox = torch.as_tensor(bbox, dtype = torch.float32).unsqueeze(0)
-        area = (bbox[..., 2] - bbox[..., 0]) * (bbox[..., 3] - bbox[..., 1])
-        iscrowd = torch.zeros(len(bbox), dtype = torch.uint8)
-        labels = torch.tensor(self.category_idx[m['category']]).unsqueeze(0)
-        masks = mask.unsqueeze(0)
-        object_location = torch.as_tensor(m['trans_mat'], dtype = torch.float32).unsqueeze(0)
-        object_rotation = torch.as_tensor(m['rot_mat'  ], dtype = torch.float32).unsqueeze(0)
-        shape_idx = torch.tensor(self.shape_idx[m['model']]).unsqueeze(0)
+        # clone as transforms modify boxes in-place
+        t = {k : v[idx : idx + 1].clone() for k, v in self.target_tensors.items()}
 
         target = dict(
             image_id   = m['img'],
@@ -63,27 +122,67 @@ class Pix3d(torchvision.datasets.VisionDataset):
             mask_path  = m['mask'],
             category   = m['category'],
             
-            boxes = bbox, # xyxy
-            area = area,
-            iscrowd = iscrowd,
-            labels = labels,
-            masks = masks, 
+            boxes = t['boxes'], # xyxy
+            area = t['area'],
+            iscrowd = t['iscrowd'],
+            labels = t['labels'],
+            masks = mask.unsqueeze(0), 
 
             image_height_width = (height, width),
-            shape_idx = shape_idx,
-            object_location = object_location,
-            object_rotation = object_rotation
+            shape_idx = t['shape_idx'],
+            object_location = t['object_location'],
+            object_rotation = t['object_rotation']
         )
         
+        if self.target_image_size:
+            # boxes and masks are rescaled here, encoded JPEG bytes are resized in batch on device by datasets.decode_images
+            newh, neww = self.target_image_size
+            # images and masks from a cache built with the same target_image_size already have it
+            image = Fv.resize(image, [newh, neww], interpolation = Fv.InterpolationMode.BILINEAR, antialias = False) if read_image and image.ndim == 3 and tuple(image.shape[-2:]) != (newh, neww) else image
+            target['masks'] = F.interpolate(target['masks'].to(torch.uint8), (newh, neww), mode = 'nearest').to(torch.bool) if read_mask and tuple(target['masks'].shape[-2:]) != (newh, neww) else target['masks']
+            target['boxes'][..., 0::2] *= neww / width
+            target['boxes'][..., 1::2] *= newh / height
+            target['area'] *= (neww / width) * (newh / height)
+            target['image_height_width_resized'] = (newh, neww)
+
         if self.transforms:
             image, target = self.transforms(image, target)
 
+        # images stay uint8 through the data loader (4x less to pin and transfer), converted to float on device by train.to_device
         return image, target
 
     def __len__(self):
         return len(self.metadata)
 
-    def as_coco_dataset(self):
+    def load(self, path, mode = torchvision.io.ImageReadMode.RGB):
+        if self.cache_index is None:
+            return load_image(os.path.join(self.root, path), mode)
+        
+        if self.cache_data is None:
+            # private file mapping opened lazily in each worker, pages are shared through the page cache and nothing is pickled
+            self.cache_data = torch.from_file(self.cache_path, shared = False, size = os.path.getsize(self.cache_path), dtype = torch.uint8)
+        offset, shape = self.cache_index[path]
+        return self.cache_data[offset : offset + math.prod(shape)].view(shape)
+
+    def build_cache(self, cache_path):
+        # decoded uint8 CHW images (RGB) and masks (GRAY) are written back to back, resized to target_image_size if set (bilinear / nearest, as in __getitem__)
+        # offset and shape by file name go to cache_path + '.pt' along with the size, a dataset with a different target_image_size refuses the cache
+        resize = lambda img, interpolation: Fv.resize(img, list(self.target_image_size), interpolation = interpolation, antialias = False) if self.target_image_size else img
+        cache_index = {}
+        with open(cache_path, 'wb') as f:
+            for m in self.metadata:
+                for path, mode, interpolation in [(m['img'], torchvision.io.ImageReadMode.RGB, Fv.InterpolationMode.BILINEAR), (m['mask'], torchvision.io.ImageReadMode.GRAY, Fv.InterpolationMode.NEAREST)]:
+                    img = resize(load_image(os.path.join(self.root, path), mode), interpolation).contiguous()
+                    cache_index[path] = (f.tell(), tuple(img.shape))
+                    f.write(img.numpy().tobytes())
+        torch.save(dict(target_image_size = tuple(self.target_image_size) if self.target_image_size else None, index = cache_index), cache_path + '.pt')
+        return cache_index
+
+    def as_coco_dataset(self, num_threads = 8):
+        # mask decoding and RLE encoding release the GIL, masks of different sizes are encoded one by one in a thread pool
+        with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+            segmentation = list(executor.map(lambda m: mask_to_rle(self.load(m['mask'], torchvision.io.ImageReadMode.GRAY)[0] == 255), self.metadata))
+
         # annotation IDs need to start at 1, not 0, see https://github.com/pytorch/vision/issues/1530
         coco_dataset = pycocotools.coco.COCO()
         coco_dataset.dataset = dict(
@@ -96,7 +195,7 @@ class Pix3d(torchvision.datasets.VisionDataset):
                 iscrowd = 0, 
                 area = (m['bbox'][2] - m['bbox'][0]) * (m['bbox'][3] - m['bbox'][1]), 
                 category_id = self.category_idx[m['category']], 
-                segmentation = mask_to_rle(torchvision.io.read_image(os.path.join(self.root, m['mask']))[0] == 255),
+                segmentation = segmentation[image_idx],
 
                 rot_mat = m['rot_mat'], 
                 trans_mat = m['trans_mat'],
@@ -109,3 +208,13 @@ class Pix3d(torchvision.datasets.VisionDataset):
         assert all(isinstance(ann['segmentation'], dict) for ann in coco_dataset.dataset['annotations'])
         coco_dataset.createIndex()
         return coco_dataset
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset-root', default = 'data/common/pix3d')
+    parser.add_argument('--cache-path', '-o', default = 'data/pix3d_cache.bin')
+    parser.add_argument('--image-size', type = int, nargs = 2, metavar = ('HEIGHT', 'WIDTH'), help = 'store images resized to this size, must match train.py --image-size')
+    args = parser.parse_args()
+
+    Pix3d(args.dataset_root, target_image_size = args.image_size).build_cache(args.cache_path)
+    print(args.cache_path)
@@ -21,11 +21,27 @@ import bpy
 import mathutils
 
 def delete_mesh_objects():
-    bpy.ops.object.select_all(action = 'DESELECT')
-    for obj in bpy.data.objects:
-        if obj.type == 'MESH':
-            obj.select_set(True)
-    bpy.ops.object.delete()
+    # data API instead of select + bpy.ops.object.delete: no depsgraph update per operator call
+    # meshes, materials and textures of previously imported models are purged as well so they do not pile up over thousands of models
+    bpy.data.batch_remove([obj for obj in bpy.data.objects if obj.type == 'MESH'])
+    bpy.data.batch_remove([block for blocks in [bpy.data.meshes, bpy.data.materials, bpy.data.images] for block in blocks if block.users == 0 and getattr(block, 'type', None) != 'RENDER_RESULT'])
+
+def import_model(root, model_path, mesh_cache_path = None):
+    # OBJ parsing dominates per-model time, the imported mesh is saved once as .blend and appended from there afterwards
+    cache_blend = os.path.join(mesh_cache_path, model_path + '.blend') if mesh_cache_path else None
+    if cache_blend and os.path.exists(cache_blend):
+        with bpy.data.libraries.load(cache_blend, link = False) as (data_from, data_to):
+            data_to.meshes = data_from.meshes[:1]
+        obj = bpy.data.objects.new(os.path.basename(model_path), data_to.meshes[0])
+        bpy.context.scene.collection.objects.link(obj)
+        return obj
+    
+    bpy.ops.import_scene.obj(filepath = os.path.join(root, model_path), axis_forward = '-Z', axis_up = 'Y')
+    obj = bpy.context.selected_objects[0]
+    if cache_blend:
+        os.makedirs(os.path.dirname(cache_blend), exist_ok = True)
+        bpy.data.libraries.write(cache_blend, {obj.data})
+    return obj
 
 def configure_camera(camera_obj, lens):
     camera_obj.location = (0, 0, 0)
@@ -36,7 +52,7 @@ def configure_camera(camera_obj, lens):
     camera_obj.data.sensor_fit = 'HORIZONTAL'
     camera_obj.data.lens = lens 
 
-def configure_scene_render(scene_render, resolution_x, resolution_y, tiles, color_mode, color_depth, file_format = 'JPEG'):
+def configure_scene_render(scene_render, resolution_x, resolution_y, tiles, color_mode, color_depth, file_format = 'JPEG', threads = None):
     scene_render.engine = 'CYCLES'
     scene_render.image_settings.file_format = file_format
     scene_render.use_overwrite = True
@@ -46,33 +62,55 @@ def configure_scene_render(scene_render, resolution_x, resolution_y, tiles, colo
     scene_render.resolution_percentage = 100
     scene_render.tile_x = tiles
     scene_render.tile_y = tiles 
+    # Blender defaults to AUTO (all cores), shards sharing a host get a fixed slice each instead of oversubscribing the CPU
+    if threads:
+        scene_render.threads_mode = 'FIXED'
+        scene_render.threads = threads
     scene_render.image_settings.color_mode = color_mode
     scene_render.image_settings.color_depth = color_depth
     
-def enable_gpu(gpu):
-    if gpu:
-        #bpy.context.user_preferences.addons['cycles'].preferences.devices[0].use = True
-        #bpy.context.user_preferences.addons['cycles'].preferences.compute_device_type = 'CUDA'
-        bpy.types.CyclesRenderSettings.device = 'GPU'
-        bpy.data.scenes[bpy.context.scene.name].cycles.device = 'GPU'
+def enable_gpu(gpu, compute_device_types = ('OPTIX', 'CUDA', 'HIP')):
+    # returns whether Cycles will render on GPU, falls back to CPU if no device of any compute_device_types is found
+    if not gpu:
+        return False
+    
+    prefs = bpy.context.preferences.addons['cycles'].preferences
+    for compute_device_type in compute_device_types:
+        try:
+            prefs.compute_device_type = compute_device_type
+        except TypeError:
+            # not supported by this Blender build, e.g. HIP before 3.0
+            continue
+        getattr(prefs, 'refresh_devices', prefs.get_devices)()
+        if any(d.type == compute_device_type for d in prefs.devices):
+            for d in prefs.devices:
+                d.use = d.type != 'CPU'
+            bpy.context.scene.cycles.device = 'GPU'
+            print('Rendering on', compute_device_type, [d.name for d in prefs.devices if d.use])
+            return True
+    
+    print('No GPU found, rendering on CPU')
+    return False
 
 def init_camera_scene_regular(samples = 5):
     camera_obj = bpy.data.objects['Camera']
     camera_obj.data.clip_end = 1e10
     
     cycles = bpy.context.scene.cycles
-    cycles.use_progressive_refine = True
+    # background-less grayscale views of a single object, longer light paths add render time but nothing visible
+    cycles.use_progressive_refine = False
     cycles.samples = samples
-    cycles.max_bounces = 100
-    cycles.min_bounces = 10
+    cycles.use_denoising = False
+    cycles.max_bounces = 4
+    cycles.min_bounces = 1
     cycles.caustics_reflective = False
     cycles.caustics_refractive = False
-    cycles.diffuse_bounces = 10
-    cycles.glossy_bounces = 4
-    cycles.transmission_bounces = 4
+    cycles.diffuse_bounces = 2
+    cycles.glossy_bounces = 1
+    cycles.transmission_bounces = 1
     cycles.volume_bounces = 0
-    cycles.transparent_min_bounces = 8
-    cycles.transparent_max_bounces = 64
+    cycles.transparent_min_bounces = 1
+    cycles.transparent_max_bounces = 4
     cycles.blur_glossy = 5
     cycles.sample_clamp_indirect = 5
     
@@ -109,6 +147,7 @@ def init_camera_scene_depth(color_mode, color_depth, clip_start = 0.5, clip_end
     return file_output_node
 
 def render_ground_truth_pose(metadata, args, color_mode, color_depth):
+    metadata = metadata[args.shard_index :: args.num_shards]
     for i, m in enumerate(metadata):
         print(i, '/', len(metadata), m['img'])
         category = m['category']
@@ -124,12 +163,11 @@ def render_ground_truth_pose(metadata, args, color_mode, color_depth):
         frame_dir = os.path.dirname(frame_path)
         os.makedirs(frame_dir, exist_ok = True)
     
-        configure_scene_render(bpy.data.scenes[bpy.context.scene.name].render, w, h, args.tiles, color_mode = color_mode, color_depth = color_depth)
+        configure_scene_render(bpy.data.scenes[bpy.context.scene.name].render, w, h, args.tiles, color_mode = color_mode, color_depth = color_depth, threads = args.threads)
         configure_camera(bpy.data.objects['Camera'], f)
         
         delete_mesh_objects()
-        bpy.ops.import_scene.obj(filepath = os.path.join(os.path.dirname(args.input_path), model_path), axis_forward='-Z', axis_up='Y')
-        obj = bpy.context.selected_objects[0]
+        obj = import_model(os.path.dirname(args.input_path), model_path, args.mesh_cache_path)
         
         obj.matrix_world = mathutils.Matrix.Translation(trans_vec) @ mathutils.Matrix(rot_mat).to_4x4()
     
@@ -141,10 +179,12 @@ def render_ground_truth_pose(metadata, args, color_mode, color_depth):
 def render_synthetic_views(metadata, args, color_mode, color_repth, viewpoints_by_category):
     w, h = args.wh
 
-    configure_scene_render(bpy.data.scenes[bpy.context.scene.name].render, w, h, args.tiles, color_mode = color_mode, color_depth = color_depth)
+    configure_scene_render(bpy.data.scenes[bpy.context.scene.name].render, w, h, args.tiles, color_mode = color_mode, color_depth = color_depth, threads = args.threads)
     configure_camera(bpy.data.objects['Camera'], args.focal_length)
+    # the mesh stays put and camera and lights move by the inverse object transform: same image, but Cycles does not re-upload the instance
+    base_matrix_world = {obj.name : obj.matrix_world.copy() for obj in bpy.data.objects if obj.type in ['CAMERA', 'LIGHT']}
     
-    model_paths = sorted(set(m['model'] for m in metadata))
+    model_paths = sorted(set(m['model'] for m in metadata))[args.shard_index :: args.num_shards]
     for i, model_path in enumerate(model_paths):
         print(i, '/', len(model_paths), model_path)
         category = os.path.basename(os.path.dirname(os.path.dirname(model_path)))
@@ -156,14 +196,14 @@ def render_synthetic_views(metadata, args, color_mode, color_repth, viewpoints_b
 
         delete_mesh_objects()    
 
-        bpy.ops.import_scene.obj(filepath=os.path.join(os.path.dirname(args.input_path), model_path), axis_forward='-Z', axis_up='Y')
-        obj = bpy.context.selected_objects[0]
+        obj = import_model(os.path.dirname(args.input_path), model_path, args.mesh_cache_path)
+        obj.matrix_world = mathutils.Matrix.Identity(4)
         for k, quat in enumerate(viewpoints_by_category[category]):
             frame_path = os.path.join(frame_dir, '{:04}.jpg'.format(1 + k))
             
-            obj.rotation_mode = 'QUATERNION'
-            obj.rotation_quaternion = quat[-1:] + quat[:3]
-            obj.location = args.object_location
+            view_matrix = (mathutils.Matrix.Translation(args.object_location) @ mathutils.Quaternion(quat[-1:] + quat[:3]).to_matrix().to_4x4()).inverted()
+            for name, matrix_world in base_matrix_world.items():
+                bpy.data.objects[name].matrix_world = view_matrix @ matrix_world
             
             #file_output_node.base_path = os.path.dirname(frame_path)
             #file_output_node.file_slots[0].path = '####.jpg'
@@ -183,10 +223,14 @@ if __name__ == '__main__':
     parser.add_argument('--input-path', '-i', default = 'data/common/pix3d/pix3d.json')
     parser.add_argument('--output-path', '-o', default = 'data/pix3d_renders')
     parser.add_argument('--viewpoints-path', default = 'pix3d_clustered_viewpoints.json')
+    parser.add_argument('--mesh-cache-path', help = 'directory for .blend copies of imported OBJ models, reused on later renders')
     parser.add_argument('--seed', type = int, default = 42)
-    parser.add_argument('--gpu', action = 'store_true')
+    parser.add_argument('--cpu', action = 'store_true', help = 'render on CPU even if a GPU is available')
     parser.add_argument('--category', nargs = '*')
-    parser.add_argument('--tiles', type = int, default = 16)
+    parser.add_argument('--shard-index', type = int, default = 0, help = 'render only every --num-shards-th image / model starting at this one, see scripts/render_pix3d.sh')
+    parser.add_argument('--num-shards', type = int, default = 1)
+    parser.add_argument('--threads', type = int, help = 'CPU threads per process, defaults to all cores divided by --num-shards')
+    parser.add_argument('--tiles', type = int, help = 'defaults to 256 on GPU and 32 on CPU')
     parser.add_argument('--samples', type = int, default = 50)
     parser.add_argument('--wh', type = int, nargs = 2, default = [128, 128])
     parser.add_argument('--render-ground-truth-views', action = 'store_true')
@@ -205,10 +249,15 @@ if __name__ == '__main__':
     world.light_settings.use_ambient_occlusion = True
     world.light_settings.ao_factor = 0.9
     bpy.context.scene.camera = bpy.data.objects['Camera']
-    enable_gpu(args.gpu)
+    gpu = enable_gpu(not args.cpu)
+    # large tiles keep the GPU busy, small ones balance the CPU threads
+    args.tiles = args.tiles or (256 if gpu else 32)
+    args.threads = args.threads or (max(1, os.cpu_count() // args.num_shards) if args.num_shards > 1 else None)
 
     #file_output_node = init_camera_scene_depth(color_mode = color_mode, color_depth = color_depth)
     init_camera_scene_regular(samples = args.samples)
+    # keep BVH and compiled shaders between renders of the same scene
+    bpy.context.scene.render.use_persistent_data = True
 
     if args.render_ground_truth_views:
         render_ground_truth_pose(metadata, args, color_mode, color_depth)
@@ -0,0 +1,10 @@
+# one Blender process per GPU, each renders its own shard of the models, extra arguments are passed to render_pix3d.py
+blender=${blender:-blender}
+NUM_SHARDS=${NUM_SHARDS:-$(nvidia-smi -L 2>/dev/null | wc -l)}
+# no GPU: a single process that render_pix3d.py runs on CPU
+if [ "$NUM_SHARDS" -lt 1 ]; then NUM_SHARDS=1; fi
+
+for ((i = 0; i < NUM_SHARDS; i++)); do
+    CUDA_VISIBLE_DEVICES=$i $blender -noaudio --background --python render_pix3d.py -- --shard-index $i --num-shards $NUM_SHARDS "$@" &
+done
+wait
@@ -18,6 +18,7 @@ import torch
 import torch.utils.data
 import torch.utils.tensorboard
 import torch.nn.functional as F
+import torchvision
 
 import datasets
 import models
@@ -30,9 +31,24 @@ import pix3d_eval
 import coco_eval 
 
 detach_cpu = lambda tensor: tensor.detach().cpu()
-to_device = lambda images, targets, device: (images.to(device), {k: v.to(device) if torch.is_tensor(v) else v for k, v in targets.items()})
-from_device = lambda outputs: [{k: v.cpu() if torch.is_tensor(v) else v for k, v in t.items()} for t in outputs]
-mix_losses = lambda loss_dict, loss_weights: sum(loss_dict[k] * loss_weights.get(k, 1.0) for k in loss_dict)
+mix_losses = lambda loss_dict, loss_weights = {}: torch.stack([loss_dict[k] * loss_weights.get(k, 1.0) for k in loss_dict]).sum()
+autocast = lambda args: torch.autocast(device_type = torch.device(args.device).type, dtype = getattr(torch, args.amp or 'bfloat16'), enabled = args.amp is not None)
+
+def from_device(outputs):
+    # non_blocking device-to-host copies land in pinned memory and are queued back to back, a single synchronize waits for all of them
+    outputs = [{k: v.to('cpu', non_blocking = True) if torch.is_tensor(v) else v for k, v in t.items()} for t in outputs]
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return outputs
+
+def to_device(images, targets, device):
+    # lists hold encoded JPEG images / views (see --decode-on-device) that are decoded in batch on device
+    images = datasets.stack_jagged(datasets.decode_images(images, device, image_height_width = targets['image_height_width_resized'].tolist())) if isinstance(images, list) else images.to(device, non_blocking = True)
+    images = images if images.is_floating_point() else images.float().div_(255.0)
+    targets = {k: v.to(device, non_blocking = True) if torch.is_tensor(v) else v for k, v in targets.items()}
+    if isinstance(targets.get('shape_views'), list):
+        targets['shape_views'] = torch.stack(datasets.decode_images(targets['shape_views'], device, mode = torchvision.io.ImageReadMode.GRAY)).unflatten(0, (len(images), -1))
+    return images, targets
 
 def split_list(l, n):
     cumsum = torch.tensor(n).cumsum(dim = -1).tolist()
@@ -43,30 +59,34 @@ def recall(pred_idx, true_idx, K = 1):
     assert pred_idx.ndim == true_idx.ndim
     return (pred_idx == true_idx).any(dim = -1).float().mean()
 
-def LinearLR(optimizer, start_factor, total_iters):
-    # TODO: replace with torch.optim.lr_scheduler.LinearL upon a new pytorch release
-    return torch.optim.lr_scheduler.LambdaLR(optimizer, lambda x: 1 if x >= total_iters else start_factor * (1 - x / total_iters) + x / total_iters)
-
-def train_one_epoch(log, tensorboard, epoch, iteration, model, optimizer, train_data_loader, device, print_freq, args):
+def train_one_epoch(log, tensorboard, epoch, iteration, model, optimizer, lr_scheduler, scaler, train_data_loader, device, print_freq, args):
     metric_logger = utils.MetricLogger()
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
 
-    lr_scheduler_warmup = LinearLR(optimizer, start_factor = 1. / 1000, total_iters = min(1000, len(train_data_loader) - 1)) if epoch == 0 else None
+    # rendered views are augmented in batch on device instead of per example in data loader workers
+    shape_view_augmentations = transforms.Mask2CADAugmentations() if args.mode == 'Mask2CAD' else None
 
+    first_iteration = iteration
     model.train()
-    for images, targets in metric_logger.log_every(train_data_loader, print_freq, header = 'Epoch: [{}]'.format(epoch)):
-        images, targets = to_device(images, targets, device = args.device)
-        loss_dict = model(images, targets, mode = args.mode)
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
-        loss = mix_losses(loss_dict, args.loss_weights) if args.mode == 'Mask2CAD' else sum(loss_dict.values())
+    for images, targets in metric_logger.log_every(datasets.CUDAPrefetcher(train_data_loader, args.device, to_device), print_freq, header = 'Epoch: [{}]'.format(epoch)):
+        if shape_view_augmentations is not None:
+            images, targets = shape_view_augmentations(images, targets)
+        with autocast(args):
+            loss_dict = model(images, targets, mode = args.mode)
+        loss = mix_losses(loss_dict, args.loss_weights)
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        if lr_scheduler_warmup is not None:
-            lr_scheduler_warmup.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        lr_scheduler.step()
 
-        if utils.is_main_process():
+        # reduce_dict is a collective blocking all ranks and float() syncs with the device, so both only run on the iterations metric_logger.log_every prints
+        i = iteration - first_iteration
+        log_iteration = i % print_freq == 0 or i == len(train_data_loader) - 1
+        if log_iteration:
+            loss_dict_reduced = utils.reduce_dict(loss_dict)
+        if log_iteration and utils.is_main_process():
             metric_logger.update(loss = float(mix_losses(loss_dict_reduced, args.loss_weights)), lr = optimizer.param_groups[0]['lr'], **loss_dict_reduced)
             log.write(json.dumps(dict(epoch = epoch, iteration = iteration, **metric_logger.last)) + '\n')
             #tensorboard.add_scalars('', value, iteration)
@@ -78,7 +98,7 @@ def train_one_epoch(log, tensorboard, epoch, iteration, model, optimizer, train_
 def evaluate(log, tensorboard, epoch, iteration, model, val_data_loader, shape_data_loader, evaluator_detection, evaluator_mesh, args, device, K = 10):
     metric_logger = utils.MetricLogger()
     
-    shape_retrieval = models.ShapeRetrieval(shape_data_loader, model.rendered_view_encoder)
+    shape_retrieval = models.ShapeRetrieval(shape_data_loader, model.rendered_view_encoder, dtype = getattr(torch, args.amp or 'float32'))
     shape_retrieval.synchronize_between_processes()
     
     pred_shape_idx, true_shape_idx = utils.CatTensors(), utils.CatTensors()
@@ -88,7 +108,8 @@ def evaluate(log, tensorboard, epoch, iteration, model, val_data_loader, shape_d
     for images, targets in metric_logger.log_every(val_data_loader, 100, header = 'Test:'):
 
         tic = time.time()
-        detections = model(*to_device(images, targets, device = args.device), mode = args.device)
+        with autocast(args):
+            detections = model(*to_device(images, targets, device = args.device), mode = 'Mask2CAD')
         num_boxes = [len(d['boxes']) for d in detections]
 
         shape_idx_, shape_path_ = shape_retrieval(torch.cat([d['shape_embedding'] for d in detections]))
@@ -117,7 +138,7 @@ def evaluate(log, tensorboard, epoch, iteration, model, val_data_loader, shape_d
         break
     
     if args.distributed:
-        for obj in [pred_shape_ids, true_shape_idx, pred_category_idx, true_category_idx, metric_logger, evaluator_detection, evaluator_mesh]:
+        for obj in [pred_shape_idx, true_shape_idx, pred_category_idx, true_category_idx, metric_logger, evaluator_detection, evaluator_mesh]:
             obj.synchronize_between_processes()
     print('Averaged stats:', metric_logger)
     if utils.is_main_process():
@@ -135,6 +156,9 @@ def evaluate(log, tensorboard, epoch, iteration, model, val_data_loader, shape_d
 def main(args):
     os.makedirs(args.output_path, exist_ok = True)
     utils.init_distributed_mode(args)
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     torch.manual_seed(args.seed)
     if torch.cuda.is_available():
         torch.cuda.manual_seed_all(args.seed)
@@ -142,12 +166,12 @@ def main(args):
     log = open(args.log, 'w') if utils.is_main_process() else None
     tensorboard = torch.utils.tensorboard.SummaryWriter(args.tensorboard) if utils.is_main_process() else None
 
-    train_dataset = pix3d.Pix3d(args.dataset_root, split_path = args.train_metadata_path, transforms = transforms.MaskRCNNAugmentations() if args.mode == 'MaskRCNN' else None)
-    train_dataset_with_views = datasets.RenderedViews(args.dataset_rendered_views_root, args.dataset_object_rotation_quat, train_dataset, transforms = transforms.Mask2CADAugmentations() if args.mode == 'Mask2CAD' else None)
+    train_dataset = pix3d.Pix3d(args.dataset_root, split_path = args.train_metadata_path, transforms = transforms.MaskRCNNAugmentations() if args.mode == 'MaskRCNN' else None, encoded_images = args.decode_on_device and args.mode == 'Mask2CAD', cache_path = args.dataset_cache_path, target_image_size = args.image_size)
+    train_dataset_with_views = datasets.RenderedViews(args.dataset_rendered_views_root, args.dataset_object_rotation_quat, train_dataset, encoded_views = args.decode_on_device)
     aspect_ratios, object_rotation_quat = train_dataset.aspect_ratios, train_dataset_with_views.object_rotation_quat
     
-    val_dataset = pix3d.Pix3d(args.dataset_root, split_path = args.val_metadata_path)
-    val_dataset_with_views = datasets.RenderedViews(args.dataset_rendered_views_root, args.dataset_object_rotation_quat, val_dataset, read_image = True, read_mask = True)
+    val_dataset = pix3d.Pix3d(args.dataset_root, split_path = args.val_metadata_path, encoded_images = args.decode_on_device, cache_path = args.dataset_cache_path, target_image_size = args.image_size)
+    val_dataset_with_views = datasets.RenderedViews(args.dataset_rendered_views_root, args.dataset_object_rotation_quat, val_dataset, read_image = True, read_mask = True, encoded_views = args.decode_on_device)
     shape_dataset_with_views = datasets.RenderedViews(args.dataset_rendered_views_root, args.dataset_object_rotation_quat, val_dataset, read_image = False, read_mask = False)
     
     #val_dataset_as_coco = val_dataset.as_coco_dataset()
@@ -156,6 +180,9 @@ def main(args):
     evaluator_detection = coco_eval.CocoEvaluator(val_dataset_as_coco, ['bbox', 'segm'])
     evaluator_mesh = pix3d_eval.Pix3dEvaluator(val_dataset, val_dataset_as_coco)
    
+    # workers outlive epochs so that module imports, dataset copies and the lazily mapped image cache are set up once
+    data_loader_kwargs = dict(num_workers = args.num_workers, pin_memory = args.device != 'cpu', **(dict(persistent_workers = True, prefetch_factor = 4) if args.num_workers > 0 else {}))
+
     if args.mode == 'MaskRCNN':
         
         if args.distributed: 
@@ -170,8 +197,8 @@ def main(args):
         #else:
         #    train_batch_sampler = torch.utils.data.BatchSampler(train_sampler, args.train_batch_size, drop_last=True)
         #    batch_sampler = train_batch_sampler 
-        train_data_loader = torch.utils.data.DataLoader(train_dataset, sampler = train_sampler, batch_size = args.train_batch_size, num_workers = args.num_workers, collate_fn = datasets.collate_fn,  pin_memory = args.device != 'cpu')
-        val_data_loader = torch.utils.data.DataLoader(val_dataset, batch_size = args.val_batch_size, sampler = val_sampler, num_workers = args.num_workers, collate_fn = datasets.collate_fn, pin_memory = args.device != 'cpu')
+        train_data_loader = torch.utils.data.DataLoader(train_dataset, sampler = train_sampler, batch_size = args.train_batch_size, collate_fn = datasets.collate_fn, **data_loader_kwargs)
+        val_data_loader = torch.utils.data.DataLoader(val_dataset, batch_size = args.val_batch_size, sampler = val_sampler, collate_fn = datasets.collate_fn, **data_loader_kwargs)
         shape_data_loader = None
     
     elif args.mode == 'Mask2CAD':
@@ -185,11 +212,11 @@ def main(args):
             val_sampler_with_views = datasets.DistributedSamplerWrapper(val_sampler_with_views)
             shape_sampler_with_views = datasets.DistributedSamplerWrapper(shape_sampler_with_views)
     
-        train_data_loader = torch.utils.data.DataLoader(train_dataset_with_views, sampler = train_sampler_with_views, collate_fn = datasets.collate_fn, batch_size = args.train_batch_size, num_workers = args.num_workers, pin_memory = args.device != 'cpu')
-        val_data_loader = torch.utils.data.DataLoader(val_dataset_with_views, sampler = val_sampler_with_views, collate_fn = datasets.collate_fn, batch_size = args.val_batch_size,         num_workers = args.num_workers, pin_memory = args.device != 'cpu')
-        shape_data_loader = torch.utils.data.DataLoader(val_dataset_with_views, sampler = shape_sampler_with_views, collate_fn = datasets.collate_fn, batch_size = args.shape_batch_size,   num_workers = args.num_workers, pin_memory = args.device != 'cpu')
+        train_data_loader = torch.utils.data.DataLoader(train_dataset_with_views, sampler = train_sampler_with_views, collate_fn = datasets.collate_fn, batch_size = args.train_batch_size, **data_loader_kwargs)
+        val_data_loader = torch.utils.data.DataLoader(val_dataset_with_views, sampler = val_sampler_with_views, collate_fn = datasets.collate_fn, batch_size = args.val_batch_size, **data_loader_kwargs)
+        shape_data_loader = torch.utils.data.DataLoader(val_dataset_with_views, sampler = shape_sampler_with_views, collate_fn = datasets.collate_fn, batch_size = args.shape_batch_size, **data_loader_kwargs)
 
-    model = models.Mask2CAD(num_categories = len(object_rotation_quat), object_rotation_quat = object_rotation_quat)
+    model = models.Mask2CAD(num_categories = len(object_rotation_quat), object_rotation_quat = object_rotation_quat, channels_last = args.device != 'cpu', compile_branches = args.compile_branches)
 
     model.to(args.device)
     if args.distributed and args.convert_sync_batchnorm:
@@ -198,10 +225,20 @@ def main(args):
     if args.distributed:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
         model_without_ddp = model.module
+    if args.compile:
+        # dynamic shapes cover the varying image sizes and numbers of boxes, the default mode as CUDA graphs do not fit dynamic shapes
+        model = torch.compile(model, dynamic = True)
 
-    optimizer = torch.optim.SGD([p for p in model.parameters() if p.requires_grad], lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+    optimizer = torch.optim.SGD([p for p in model.parameters() if p.requires_grad], lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay, foreach=True)
+    # float16 gradients underflow without loss scaling, bfloat16 has the float32 exponent range and needs none
+    scaler = torch.amp.GradScaler(torch.device(args.device).type, enabled = args.amp == 'float16')
     
-    lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones = args.lr_steps, gamma = args.lr_gamma) if args.lr_scheduler == 'MultiStepLR' else torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max = args.num_epochs) if args.lr_scheduler == 'CosineAnnealingLR' else None
+    # one scheduler stepped per iteration: linear warmup, then the main schedule with epoch milestones counted in iterations from the end of warmup
+    iters_per_epoch = len(train_data_loader)
+    warmup_iters = min(1000, iters_per_epoch - 1)
+    lr_scheduler_warmup = torch.optim.lr_scheduler.LinearLR(optimizer, start_factor = 1. / 1000, total_iters = warmup_iters)
+    lr_scheduler_main = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones = [step * iters_per_epoch - warmup_iters for step in args.lr_steps], gamma = args.lr_gamma) if args.lr_scheduler == 'MultiStepLR' else torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max = args.num_epochs * iters_per_epoch - warmup_iters) if args.lr_scheduler == 'CosineAnnealingLR' else torch.optim.lr_scheduler.ConstantLR(optimizer, factor = 1.0, total_iters = 0)
+    lr_scheduler = torch.optim.lr_scheduler.SequentialLR(optimizer, [lr_scheduler_warmup, lr_scheduler_main], milestones = [warmup_iters])
 
     if args.resume:
         checkpoint = torch.load(args.resume, map_location='cpu')
@@ -219,8 +256,7 @@ def main(args):
     for epoch in range(args.start_epoch, args.num_epochs):
         if train_data_loader.sampler is not None:
             (getattr(train_data_loader.sampler, 'set_epoch', None) or print)(epoch)
-        iteration = train_one_epoch(log, tensorboard, epoch, iteration, model, optimizer, train_data_loader, args.device, args.print_freq, args)
-        lr_scheduler.step()
+        iteration = train_one_epoch(log, tensorboard, epoch, iteration, model, optimizer, lr_scheduler, scaler, train_data_loader, args.device, args.print_freq, args)
 
         if False and args.output_path:
             checkpoint = dict(
@@ -247,6 +283,7 @@ if __name__ == '__main__':
     parser.add_argument('--seed', type = int, default = 42)
     
     parser.add_argument('--dataset-root', default = 'data/common/pix3d')
+    parser.add_argument('--dataset-cache-path', help = 'decoded images and masks written by python pix3d.py -o data/pix3d_cache.bin')
     parser.add_argument('--train-metadata-path', default = 'data/common/pix3d_splits/pix3d_s2_train.json')
     parser.add_argument('--val-metadata-path', default = 'data/common/pix3d_splits/pix3d_s2_test.json')
     
@@ -257,6 +294,8 @@ if __name__ == '__main__':
     parser.add_argument('--shape-batch-size', type = int, default = 1)
     parser.add_argument('--num-epochs', type = int, default = 1000)
     parser.add_argument('--num-workers', '-j', default=0, type=int)
+    parser.add_argument('--image-size', type = int, nargs = 2, metavar = ('HEIGHT', 'WIDTH'), help = 'resize Pix3D images to a fixed size, on device with --decode-on-device')
+    parser.add_argument('--decode-on-device', action = 'store_true', help = 'decode JPEG in batch on --device with nvjpeg instead of in data loader workers')
     parser.add_argument('--lr', default=0.02, type=float, help='initial learning rate, 0.02 is the default value for training on 8 gpus and 2 images_per_gpu')
     parser.add_argument('--momentum', default=0.9, type=float)
     parser.add_argument('--weight-decay', default=1e-4, type=float)
@@ -274,6 +313,9 @@ if __name__ == '__main__':
     parser.add_argument('--aspect-ratio-group-factor', default=3, type=int)
     parser.add_argument('--data-augmentation', default='hflip', help='data augmentation policy (default: hflip)')
     parser.add_argument('--convert-sync-batchnorm', action='store_true')
+    parser.add_argument('--compile', action = 'store_true', help = 'torch.compile the whole model with dynamic shapes')
+    parser.add_argument('--compile-branches', action = 'store_true', help = 'torch.compile the Mask2CAD shape / pose / center heads')
+    parser.add_argument('--amp', nargs = '?', const = 'bfloat16', choices = ['bfloat16', 'float16'], help = 'autocast dtype for training and evaluation forward passes, float16 adds loss scaling')
     parser.add_argument('--evaluate-only', action='store_true')
     
     parser.add_argument('--mode', default = 'MaskRCNN', choices = ['MaskRCNN', 'Mask2CAD'] )
@@ -1,11 +1,13 @@
 import math
 import random
+import itertools
 import torch
 import torchvision
 
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.transforms.transforms as T
+import torchvision.transforms.functional as Fv
 
 class MaskRCNNAugmentations(nn.Sequential):
     # https://detectron2.readthedocs.io/en/latest/modules/config.html#yaml-config-references
@@ -20,13 +22,45 @@ class MaskRCNNAugmentations(nn.Sequential):
             image, target = t(image, target)
         return image, target
 
-class Mask2CADAugmentations(nn.Sequential):
-    def __init__(self, shape_view_side_size = 128):
-        super().__init__(RandomPhotometricDistort(), T.RandomCrop(shape_view_side_size))
+class Mask2CADAugmentations(nn.Module):
+    # applied on device to the whole batch of rendered views [..., C, H, W] after the transfer, every view draws its own factors and crop
+    # views are rendered grayscale, so hue and channel permutation of RandomPhotometricDistort are identities and are not drawn
+    def __init__(self, shape_view_side_size = 128, contrast = (0.5, 1.5), saturation = (0.5, 1.5), brightness = (0.875, 1.125), p = 0.5):
+        super().__init__()
+        self.shape_view_side_size = shape_view_side_size
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.p = p
 
     def forward(self, image, target):
-        for t in self:
-            target['shape_views'] = t(target['shape_views'])
+        shape_views = target['shape_views']
+        views = shape_views.flatten(end_dim = -4)
+        views = views if views.is_floating_point() else views.float().div_(255.0)
+        N, C, H, W = views.shape
+        
+        lo, hi = torch.tensor([self.brightness, self.contrast, self.saturation], device = views.device).unbind(dim = -1)
+        brightness_factor, contrast_factor, saturation_factor = (lo + (hi - lo) * torch.rand(N, 3, device = views.device)).view(N, 3, 1, 1, 1).unbind(dim = 1)
+        r = torch.rand(N, 4, 1, 1, 1, device = views.device).unbind(dim = 1)
+        blend = lambda img, other, factor, apply: torch.where(apply, (factor * img + (1 - factor) * other).clamp_(0, 1), img)
+        grayscale = lambda img: Fv.rgb_to_grayscale(img) if img.shape[-3] == 3 else img
+        
+        views = blend(views, torch.zeros_like(views), brightness_factor, r[0] < self.p)
+        contrast_before = r[1] < 0.5
+        views = blend(views, grayscale(views).mean(dim = (-3, -2, -1), keepdim = True), contrast_factor, contrast_before & (r[2] < self.p))
+        if C == 3:
+            views = blend(views, grayscale(views), saturation_factor, r[3] < self.p)
+        views = blend(views, grayscale(views).mean(dim = (-3, -2, -1), keepdim = True), contrast_factor, ~contrast_before & (r[2] < self.p))
+
+        # per-view random crop as one gather over precomputed row / column offsets
+        S = self.shape_view_side_size
+        assert H >= S and W >= S, 'rendered views {}x{} are smaller than the crop size {}'.format(H, W, S)
+        y0, x0 = (torch.rand(2, N, device = views.device) * torch.tensor([[H - S + 1], [W - S + 1]], device = views.device)).long()
+        rows = (y0[:, None] + torch.arange(S, device = views.device))[:, None, :, None]
+        cols = (x0[:, None] + torch.arange(S, device = views.device))[:, None, None, :]
+        views = views[torch.arange(N, device = views.device)[:, None, None, None], torch.arange(C, device = views.device)[None, :, None, None], rows, cols]
+
+        target['shape_views'] = views.unflatten(0, shape_views.shape[:-3])
         return image, target
 
 class JitterBoxes(nn.Module):
@@ -37,9 +71,9 @@ class JitterBoxes(nn.Module):
 
     def forward(self, image, target):
         xmin, ymin, xmax, ymax = target['boxes'].unbind(dim = -1)
-        xm, ym, xp, yp = (xmax - xmin), (ymax - ymin), (xmin + xmax), (ymin + ymax)
-        j = torch.randn_like(boxes) * noise_scale
-        new_cx, new_cy, new_w_half, new_h_half = (xp / 2.0 + j[..., 0] * w), (yp / 2.0 + j[..., 1] * h), 0.5 * xm * j[..., 2].exp(), 0.5 * ym * j[..., 3].exp()
+        w, h, xp, yp = (xmax - xmin), (ymax - ymin), (xmin + xmax), (ymin + ymax)
+        j = torch.randn_like(target['boxes']) * self.noise_scale
+        new_cx, new_cy, new_w_half, new_h_half = (xp / 2.0 + j[..., 0] * w), (yp / 2.0 + j[..., 1] * h), 0.5 * w * j[..., 2].exp(), 0.5 * h * j[..., 3].exp()
         new_boxes = torch.stack([new_cx - new_w_half, new_cy - new_h_half, new_cx + new_w_half, new_cy + new_h_half], dim = -1)
         target['boxes'] = new_boxes
         return image, target
@@ -70,7 +104,8 @@ class ResizeShortestEdge(nn.Module):
         neww = int(neww + 0.5)
         newh = int(newh + 0.5)
 
-        image = F.interpolate(image.unsqueeze(0), (newh, neww), mode = self.interp, align_corners = None if self.interp == "nearest" else False).squeeze(0)
+        # keeps uint8 input as uint8, same as F.interpolate(align_corners = False) for floats
+        image = Fv.resize(image, [newh, neww], interpolation = Fv.InterpolationMode(self.interp), antialias = False)
         target['image_height_width_resized'] = (newh, neww)
         if 'boxes' in target:
             target['boxes'][..., 0::2] *= neww / w
@@ -86,7 +121,10 @@ class RandomHorizontalFlip(T.RandomHorizontalFlip):
             image = image.flip(-1)
             if target is not None:
                 width = image.shape[-1]
-                target["boxes"][:, [0, 2]] = width - target["boxes"][:, [2, 0]]
+                boxes = target["boxes"]
+                x1 = boxes[:, 0].clone()
+                boxes[:, 0] = width - boxes[:, 2]
+                boxes[:, 2] = width - x1
                 if "masks" in target:
                     target["masks"] = target["masks"].flip(-1)
         return image, target
@@ -95,11 +133,13 @@ class RandomPhotometricDistort(nn.Module):
     def __init__(self, contrast = (0.5, 1.5), saturation = (0.5, 1.5),
                  hue = (-0.05, 0.05), brightness = (0.875, 1.125), p = 0.5):
         super().__init__()
-        self._brightness = T.ColorJitter(brightness=brightness)
-        self._contrast = T.ColorJitter(contrast=contrast)
-        self._hue = T.ColorJitter(hue=hue)
-        self._saturation = T.ColorJitter(saturation=saturation)
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
         self.p = p
+        # all 6 orders of RGB channels, a shuffle draws one row instead of building a randperm index per call
+        self.rgb_permutations = torch.tensor(list(itertools.permutations(range(3))), dtype = torch.int64)
 
     def forward(self, image, target = None):
         if isinstance(image, torch.Tensor):
@@ -109,29 +149,32 @@ class RandomPhotometricDistort(nn.Module):
                 image = image.unsqueeze(0)
 
         r = torch.rand(7)
+        # all four factors in one draw, applied directly instead of through four ColorJitter modules that each resample their parameters
+        lo, hi = torch.tensor([self.brightness, self.contrast, self.saturation, self.hue]).unbind(dim = -1)
+        brightness_factor, contrast_factor, saturation_factor, hue_factor = (lo + (hi - lo) * torch.rand(4)).tolist()
 
         if r[0] < self.p:
-            image = self._brightness(image)
+            image = Fv.adjust_brightness(image, brightness_factor)
 
         contrast_before = r[1] < 0.5
         if contrast_before:
             if r[2] < self.p:
-                image = self._contrast(image)
+                image = Fv.adjust_contrast(image, contrast_factor)
 
         if r[3] < self.p:
-            image = self._saturation(image)
+            image = Fv.adjust_saturation(image, saturation_factor)
 
         if r[4] < self.p:
-            image = self._hue(image)
+            image = Fv.adjust_hue(image, hue_factor)
 
         if not contrast_before:
             if r[5] < self.p:
-                image = self._contrast(image)
+                image = Fv.adjust_contrast(image, contrast_factor)
 
-        if r[6] < self.p:
+        if r[6] < self.p and image.shape[-3] > 1:
             channels = image.shape[-3]
-            permutation = torch.randperm(channels)
+            permutation = self.rgb_permutations[torch.randint(len(self.rgb_permutations), ())] if channels == 3 else torch.randperm(channels)
 
-            image = image[..., permutation, :, :]
+            image = image.index_select(-3, permutation.to(image.device))
 
         return image, target